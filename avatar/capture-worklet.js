@@ -0,0 +1,127 @@
+// AudioWorklet capture: resample to 16kHz, convert to PCM16 and frame into
+// exactly-aligned 30ms (480-sample) VAD frames off the main thread.
+// Several frames are batched into one message so the websocket sees fewer,
+// larger sends. An optional energy gate keeps silence from being uploaded;
+// when it closes, an {eos: true} message tells the server the segment ended.
+
+const TARGET_RATE = 16000;
+const FRAME_SIZE = 480; // 30ms at 16kHz, what webrtcvad expects
+
+class CaptureProcessor extends AudioWorkletProcessor {
+    constructor(options) {
+        super();
+        const opts = (options && options.processorOptions) || {};
+        this.framesPerMessage = Math.max(1, opts.framesPerMessage || 4);
+        this.gateEnabled = !!opts.energyGate;
+        this.gateThreshold = opts.gateThreshold || 0.01;  // RMS of float samples
+        // Keep sending for a while after speech so the server still sees the
+        // trailing silence it uses to decide the child has finished talking
+        this.hangoverFrames = Math.ceil((opts.hangoverMs || 1500) / 30);
+        // Frames sent before the gate opens so word onsets aren't clipped
+        this.prerollFrames = Math.ceil((opts.prerollMs || 300) / 30);
+
+        this.paused = false;
+        this.ratio = sampleRate / TARGET_RATE;
+        this.readPos = 0;       // fractional read position into the input stream
+        this.lastSample = 0;    // last input sample of the previous block, for interpolation
+
+        this.frame = new Int16Array(FRAME_SIZE);
+        this.frameFill = 0;
+        this.frameEnergy = 0;
+        this.batch = new Int16Array(FRAME_SIZE * this.framesPerMessage);
+        this.batchFrames = 0;
+        this.preroll = [];
+        this.hangover = 0;
+
+        this.port.onmessage = (e) => {
+            if ('paused' in e.data) {
+                this.paused = e.data.paused;
+                if (this.paused) this.reset();
+            }
+        };
+    }
+
+    reset() {
+        this.frameFill = 0;
+        this.frameEnergy = 0;
+        this.batchFrames = 0;
+        this.preroll = [];
+        this.hangover = 0;
+    }
+
+    pushSample(s) {
+        s = Math.max(-1, Math.min(1, s));
+        this.frame[this.frameFill++] = s < 0 ? s * 0x8000 : s * 0x7FFF;
+        this.frameEnergy += s * s;
+        if (this.frameFill === FRAME_SIZE) {
+            this.finishFrame(Math.sqrt(this.frameEnergy / FRAME_SIZE));
+            this.frameFill = 0;
+            this.frameEnergy = 0;
+        }
+    }
+
+    finishFrame(rms) {
+        if (!this.gateEnabled) {
+            this.queueFrame(this.frame);
+            return;
+        }
+        if (rms >= this.gateThreshold) {
+            // Gate opens: flush the pre-roll first so the onset is kept
+            for (const f of this.preroll) this.queueFrame(f);
+            this.preroll = [];
+            this.hangover = this.hangoverFrames;
+            this.queueFrame(this.frame);
+        } else if (this.hangover > 0) {
+            this.hangover--;
+            this.queueFrame(this.frame);
+            if (this.hangover === 0) {
+                this.flush();
+                // Nothing more is uploaded until the gate reopens, so say so explicitly
+                this.port.postMessage({eos: true});
+            }
+        } else {
+            this.preroll.push(this.frame.slice());
+            if (this.preroll.length > this.prerollFrames) this.preroll.shift();
+        }
+    }
+
+    queueFrame(frame) {
+        this.batch.set(frame, this.batchFrames * FRAME_SIZE);
+        this.batchFrames++;
+        if (this.batchFrames === this.framesPerMessage) this.flush();
+    }
+
+    flush() {
+        if (this.batchFrames === 0) return;
+        // Transfer (not copy) the buffer to the main thread
+        const out = this.batch.slice(0, this.batchFrames * FRAME_SIZE);
+        this.port.postMessage(out.buffer, [out.buffer]);
+        this.batchFrames = 0;
+    }
+
+    process(inputs) {
+        const input = inputs[0];
+        if (this.paused || !input || input.length === 0) return true;
+        const data = input[0];
+
+        if (this.ratio === 1) {
+            for (let i = 0; i < data.length; i++) this.pushSample(data[i]);
+            return true;
+        }
+
+        // Linear-interpolation resampler; position -1 refers to lastSample
+        let pos = this.readPos;
+        while (pos < data.length - 1) {
+            const i = Math.floor(pos);
+            const frac = pos - i;
+            const a = i < 0 ? this.lastSample : data[i];
+            this.pushSample(a + (data[i + 1] - a) * frac);
+            pos += this.ratio;
+        }
+        this.readPos = pos - data.length;
+        this.lastSample = data[data.length - 1];
+        return true;
+    }
+}
+
+registerProcessor('capture-processor', CaptureProcessor);
@@ -10,6 +10,13 @@ let noseLit = false;
 let showText = false;
 
 let isSpeaking = false;
+let captureNode = null;
+
+function setSpeaking(value) {
+    isSpeaking = value;
+    // Stop the capture worklet uploading while the bot is talking
+    if (captureNode) captureNode.port.postMessage({paused: value});
+}
 
 let deferredPrompt;
 let installTriggered = false;
@@ -51,11 +58,13 @@ function initAudio() {
 let voiceConfig = {rate: 0.35, pitch: 0.15, volume: 1.0, preferred_voices: ['robot', 'computer', 'synthesizer', 'electronic', 'tts', 'dalek', 'mechanical', 'zira', 'male', 'daniel', 'alex', 'fred', 'tom', 'paul']};
 let sttConfig = {provider: 'server'};
 let ttsConfig = {provider: 'browser'};
+let captureConfig = {frames_per_message: 4, energy_gate: true, gate_threshold: 0.01, hangover_ms: 1500, preroll_ms: 300};
 fetch('/config.json').then(response => response.json())
         .then(config => {
             ttsConfig = config.tts || {provider: 'browser'};
             voiceConfig = config.voice || {rate: 1, pitch: 1, volume: 1, preferred_voices: []};
             sttConfig = config.stt || {provider: 'browser'};
+            captureConfig = Object.assign(captureConfig, config.capture || {});
             console.log('Config loaded:', {tts: ttsConfig, voice: voiceConfig, stt: sttConfig});
         }).catch(() => {
     console.log('Config not loaded, using defaults');
@@ -351,6 +360,7 @@ function toggleConnection() {
     } else {
         console.log('Connecting...');
         ws = new WebSocket((location.protocol==='https:'?'wss':'ws')+'://'+location.host+'/ws');
+        ws.binaryType = 'arraybuffer';
         setupWebSocket();
     }
 }
@@ -399,6 +409,69 @@ function handleCanvasClick(event) {
     textDiv.style.display = showText ? 'block' : 'none';
 }
 
+async function startCapture(stream) {
+    const audioContext = new (window.AudioContext || window.webkitAudioContext)({sampleRate: 16000});
+    const source = audioContext.createMediaStreamSource(stream);
+
+    if (!audioContext.audioWorklet) {
+        startScriptProcessorCapture(audioContext, source);
+        return;
+    }
+
+    // Resampling, PCM16 conversion and 30ms framing happen in the worklet
+    try {
+        await audioContext.audioWorklet.addModule('/static/capture-worklet.js');
+    } catch (err) {
+        console.error('Audio worklet failed to load:', err);
+        startScriptProcessorCapture(audioContext, source);
+        return;
+    }
+    captureNode = new AudioWorkletNode(audioContext, 'capture-processor', {
+        numberOfInputs: 1,
+        numberOfOutputs: 0,
+        channelCount: 1,
+        processorOptions: {
+            framesPerMessage: captureConfig.frames_per_message,
+            energyGate: captureConfig.energy_gate,
+            gateThreshold: captureConfig.gate_threshold,
+            hangoverMs: captureConfig.hangover_ms,
+            prerollMs: captureConfig.preroll_ms
+        }
+    });
+    captureNode.port.onmessage = (e) => {
+        // e.data is a batch of whole 480-sample PCM16 frames, or {eos: true} when the gate closes
+        if (isSpeaking) return;
+        if (ws && ws.readyState === WebSocket.OPEN) {
+            ws.send(e.data instanceof ArrayBuffer ? e.data : JSON.stringify(e.data));
+        }
+    };
+    source.connect(captureNode);
+    console.log('Audio worklet capture started');
+}
+
+function startScriptProcessorCapture(audioContext, source) {
+    // Fallback for browsers without AudioWorklet (older iOS Safari)
+    const processor = audioContext.createScriptProcessor(512, 1, 1); // ~32ms at 16kHz (closest power of 2)
+
+    source.connect(processor);
+    processor.connect(audioContext.destination);
+
+    console.log('Audio processing started (ScriptProcessor fallback)');
+    processor.onaudioprocess = (e) => {
+        if (isSpeaking) return; // Skip processing while speaking
+        const inputData = e.inputBuffer.getChannelData(0);
+        // Convert float32 [-1, 1] to int16 PCM
+        const pcm16 = new Int16Array(inputData.length);
+        for (let i = 0; i < inputData.length; i++) {
+            const s = Math.max(-1, Math.min(1, inputData[i]));
+            pcm16[i] = s < 0 ? s * 0x8000 : s * 0x7FFF;
+        }
+        if (ws.readyState === WebSocket.OPEN) {
+            ws.send(pcm16.buffer);
+        }
+    };
+}
+
 function setupWebSocket() {
     ws.onopen = () => {
         console.log('WebSocket opened');
@@ -420,27 +493,7 @@ function setupWebSocket() {
                     }
                 } else {
                     // Server STT: process audio
-                    const audioContext = new (window.AudioContext || window.webkitAudioContext)({sampleRate: 16000});
-                    const source = audioContext.createMediaStreamSource(stream);
-                    const processor = audioContext.createScriptProcessor(512, 1, 1); // ~32ms at 16kHz (closest power of 2)
-                    
-                    source.connect(processor);
-                    processor.connect(audioContext.destination);
-                    
-                    console.log('Audio processing started');
-                    processor.onaudioprocess = (e) => {
-                        if (isSpeaking) return; // Skip processing while speaking
-                        const inputData = e.inputBuffer.getChannelData(0);
-                        // Convert float32 [-1, 1] to int16 PCM
-                        const pcm16 = new Int16Array(inputData.length);
-                        for (let i = 0; i < inputData.length; i++) {
-                            const s = Math.max(-1, Math.min(1, inputData[i]));
-                            pcm16[i] = s < 0 ? s * 0x8000 : s * 0x7FFF;
-                        }
-                        if (ws.readyState === WebSocket.OPEN) {
-                            ws.send(pcm16.buffer);
-                        }
-                    };
+                    startCapture(stream);
                 }
             }).catch(err => {
                 setStatus('mic blocked: ' + err.name, '#d32f2f');
@@ -472,40 +525,20 @@ function setupWebSocket() {
                             break;
                         case 'idle': setStatus('idle', '#555'); break;
                         case 'error': setStatus('error: '+(data.message||''), '#d32f2f'); break;
+                        case 'busy': setStatus('busy', '#999'); break;
                     }
                     return;
                 }
                 if (data.text) {
                     if (showText) textDiv.textContent = data.text;
-                    if (ttsConfig.provider === 'browser') {
+                    // Server asks for browser TTS when it is under resource pressure
+                    if (ttsConfig.provider === 'browser' || data.tts === 'browser') {
                         speakText(data.text);
                     }
                 }
-            if (data.audio) {
+            if (data.audio && data.audio !== 'binary') {
                 console.log('Received audio, length:', data.audio.length);
-                const audio = new Audio('data:audio/wav;base64,' + data.audio);
-                audio.volume = 1.0;
-                audio.muted = false;
-                let animationInterval;
-                audio.onplay = () => {
-                    isSpeaking = true;
-                    console.log('Audio started playing');
-                    // Mouth animation while audio plays
-                    animationInterval = setInterval(() => {
-                        const jawOpen = Math.random() > 0.5 ? 1 : 0.5;
-                        drawFace(jawOpen);
-                    }, 150);
-                };
-                audio.onended = () => {
-                    isSpeaking = false;
-                    console.log('Audio ended');
-                    clearInterval(animationInterval);
-                    drawFace(0);
-                    setStatus('idle', '#555');
-                };
-                audio.play().then(() => {
-                    console.log('Audio play promise resolved');
-                }).catch(err => console.error('Audio play error:', err));
+                playAudio('data:audio/wav;base64,' + data.audio);
             }
             if (data.log) {
                 console.log(data.log);
@@ -516,13 +549,44 @@ function setupWebSocket() {
         } catch {
             // not JSON, ignore
         }
+    } else if (e.data instanceof ArrayBuffer) {
+        // Server TTS: WAV bytes sent as a binary frame after the text message
+        console.log('Received audio, bytes:', e.data.byteLength);
+        const url = URL.createObjectURL(new Blob([e.data], {type: 'audio/wav'}));
+        playAudio(url, () => URL.revokeObjectURL(url));
     }
-    // No longer handling binary audio data
 };
     ws.onclose = () => setStatus('disconnected', '#999');
     ws.onerror = () => setStatus('error', '#d32f2f');
 }
 
+function playAudio(src, onDone) {
+    const audio = new Audio(src);
+    audio.volume = 1.0;
+    audio.muted = false;
+    let animationInterval;
+    audio.onplay = () => {
+        setSpeaking(true);
+        console.log('Audio started playing');
+        // Mouth animation while audio plays
+        animationInterval = setInterval(() => {
+            const jawOpen = Math.random() > 0.5 ? 1 : 0.5;
+            drawFace(jawOpen);
+        }, 150);
+    };
+    audio.onended = () => {
+        setSpeaking(false);
+        console.log('Audio ended');
+        clearInterval(animationInterval);
+        drawFace(0);
+        setStatus('idle', '#555');
+        if (onDone) onDone();
+    };
+    audio.play().then(() => {
+        console.log('Audio play promise resolved');
+    }).catch(err => console.error('Audio play error:', err));
+}
+
 function speakText(text) {
     // Cancel any ongoing speech
     if (currentUtterance) {
@@ -557,7 +621,7 @@ function speakText(text) {
     // Animate mouth while speaking
     let animationInterval;
     utterance.onstart = () => {
-        isSpeaking = true;
+        setSpeaking(true);
         // Simple mouth animation while speaking
         let jawOpen = 0;
         animationInterval = setInterval(() => {
@@ -567,7 +631,7 @@ function speakText(text) {
     };
     
     utterance.onend = () => {
-        isSpeaking = false;
+        setSpeaking(false);
         clearInterval(animationInterval);
         drawFace(0);
         currentUtterance = null;
@@ -576,7 +640,7 @@ function speakText(text) {
     
     utterance.onerror = (err) => {
         console.error('Speech error:', err);
-        isSpeaking = false;
+        setSpeaking(false);
         clearInterval(animationInterval);
         drawFace(0);
         currentUtterance = null;
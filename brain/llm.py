@@ -5,6 +5,9 @@ from dotenv import load_dotenv
 # Load environment variables
 load_dotenv()
 
+# Reply used when the provider call fails
+FALLBACK_RESPONSE = "I'm having trouble thinking right now. Can you try again?"
+
 class LLM:
     def __init__(self, provider="api", model_name="gemini-2.0-flash-exp"):
         """Initialize LLM with provider.
@@ -134,7 +137,7 @@ class LLM:
             print(f"LLM error: {e}")
             import traceback
             traceback.print_exc()
-            return "I'm having trouble thinking right now. Can you try again?"
+            return FALLBACK_RESPONSE
     
     async def _generate_gemini_async(self, prompt):
         """Wrapper to run synchronous Gemini API call in async context."""
@@ -4,19 +4,23 @@ import asyncio
 import subprocess
 import json
 import time
-import base64
 import gc
 import psutil
 import os
 import torch
 import socket
-from fastapi import FastAPI, WebSocket, Request
+import secrets
+from fastapi import FastAPI, WebSocket, Request, Depends, HTTPException
 from fastapi.responses import FileResponse
 from starlette.staticfiles import StaticFiles
 from speech.vad import VAD
 from speech.stt import STT
-from brain.llm import LLM
+from speech.phrase_cache import PhraseCache
+from brain.llm import LLM, FALLBACK_RESPONSE
 from brain.search import Search
+from transport.outbound import OutboundQueue, get_encoder, queue_metrics
+from transport.governor import ResourceGovernor, SMALL_WHISPER, BROWSER_TTS
+from transport.profiling import SamplingProfiler, MemoryTracer, LoopMonitor, TurnTracer, list_profiles, profile_path
 import io
 
 try:
@@ -68,6 +72,8 @@ model_provider = config.get('model', {}).get('provider', args.provider)
 model_name = config.get('model', {}).get('name', args.model)
 stt_provider = config.get('stt', {}).get('provider', 'server')
 tts_provider = config.get('tts', {}).get('provider', 'browser')
+transport_config = config.get('transport', {})
+json_encoder = get_encoder(transport_config.get('json_encoder', 'json'))
 
 # Set process priority to prevent system freeze
 try:
@@ -80,11 +86,32 @@ except Exception as e:
 # Initialize models once at startup
 vad_instance = VAD()
 stt_instance = STT(whisper_model)
+# Tiny Whisper for degraded mode, loaded now so pressure never triggers a model load
+if whisper_model == 'tiny.en':
+    small_stt_instance = stt_instance
+else:
+    start_time = time.time()
+    small_stt_instance = STT('tiny.en')
+    print(f"Loaded tiny Whisper for degraded mode in {time.time() - start_time:.2f}s")
 llm_instance = LLM(model_provider, model_name)  # Using selected provider and model
 search_instance = Search()
 
+# Connection limits and staged degradation under memory/CPU/GPU pressure
+governor = ResourceGovernor(config.get('governor', {}))
+
+def get_stt(stage):
+    """Pick the Whisper model for the current governor stage."""
+    return stt_instance if stage < SMALL_WHISPER else small_stt_instance
+
 import pyttsx3
 
+def select_voice(engine):
+    """Pick the server TTS voice id (first male/English voice), or None for the default."""
+    for voice in engine.getProperty('voices'):
+        if 'male' in voice.name.lower() or 'english' in voice.name.lower():
+            return voice.id
+    return None
+
 def generate_tts(text, voice_config):
     """Generate TTS audio using pyttsx3 with config."""
     import tempfile
@@ -93,11 +120,9 @@ def generate_tts(text, voice_config):
         temp_file = f.name
     
     engine = pyttsx3.init()
-    voices = engine.getProperty('voices')
-    for voice in voices:
-        if 'male' in voice.name.lower() or 'english' in voice.name.lower():
-            engine.setProperty('voice', voice.id)
-            break
+    voice_id = select_voice(engine)
+    if voice_id:
+        engine.setProperty('voice', voice_id)
     engine.setProperty('rate', int(voice_config.get('rate', 1.0) * 180))
     engine.setProperty('volume', voice_config.get('volume', 1.0))
     # Note: pitch not directly supported in pyttsx3
@@ -110,8 +135,30 @@ def generate_tts(text, voice_config):
     os.unlink(temp_file)
     return data
 
+# Canned replies; error and timeout paths only ever play these from the cache
+LLM_TIMEOUT_RESPONSE = "Sorry, I'm taking too long to think. Can you try again?"
+BUSY_RESPONSE = "I'm chatting with lots of friends right now. Try again in a minute!"
+FALLBACK_PHRASES = {LLM_TIMEOUT_RESPONSE, FALLBACK_RESPONSE, BUSY_RESPONSE}
+
+phrase_cache = None
+if tts_provider == 'server':
+    phrase_cache = PhraseCache(
+        lambda text: generate_tts(text, voice_config),
+        voice_config,
+        voice_id=select_voice(pyttsx3.init()) or "default",
+        max_mb=config.get('tts', {}).get('cache_mb', 32),
+    )
+    # Greetings etc. from config are pre-synthesized alongside the fallbacks
+    phrase_cache.prewarm(sorted(FALLBACK_PHRASES) + config.get('tts', {}).get('phrases', []))
+
 print(f"Models initialized. Provider: {model_provider}, Model: {model_name}, Whisper: {whisper_model}, TTS: server")
 
+# Diagnostics for the admin endpoints
+cpu_profiler = SamplingProfiler()
+memory_tracer = MemoryTracer()
+loop_monitor = LoopMonitor()
+turn_tracer = TurnTracer()
+
 app = FastAPI()
 app.mount("/static", StaticFiles(directory="avatar"), name="static")
 
@@ -123,13 +170,111 @@ async def root():
 async def get_config():
     return FileResponse("config.json")
 
+@app.get("/metrics")
+async def get_metrics():
+    return {
+        "connections": queue_metrics(),
+        "governor": governor.snapshot(),
+        "phrase_cache": phrase_cache.stats() if phrase_cache else None,
+    }
+
+@app.on_event("startup")
+async def start_background_monitors():
+    loop_monitor.start()
+    governor.start()
+
+def require_admin(request: Request):
+    """Admin endpoints need ADMIN_TOKEN (from .env) in the X-Admin-Token header; disabled if unset."""
+    admin_token = os.getenv('ADMIN_TOKEN')
+    # Header only: query strings end up in the uvicorn access log
+    token = request.headers.get('x-admin-token') or ''
+    if not admin_token or not secrets.compare_digest(token, admin_token):
+        raise HTTPException(status_code=403, detail="Admin access required")
+
+@app.post("/admin/profile/cpu", dependencies=[Depends(require_admin)])
+async def start_cpu_profile(seconds: float = 30):
+    seconds = max(1, min(seconds, 300))
+    if not cpu_profiler.start(seconds):
+        raise HTTPException(status_code=409, detail="CPU profile already running")
+    return {"profiling": True, "seconds": seconds}
+
+@app.post("/admin/profile/cpu/stop", dependencies=[Depends(require_admin)])
+async def stop_cpu_profile():
+    path = await asyncio.to_thread(cpu_profiler.stop)
+    return {"file": os.path.basename(path) if path else None}
+
+@app.post("/admin/profile/memory/start", dependencies=[Depends(require_admin)])
+async def start_memory_trace():
+    if not memory_tracer.start():
+        raise HTTPException(status_code=409, detail="Memory trace already running")
+    return {"tracing": True}
+
+@app.post("/admin/profile/memory/stop", dependencies=[Depends(require_admin)])
+async def stop_memory_trace():
+    path = await asyncio.to_thread(memory_tracer.stop)
+    if path is None:
+        raise HTTPException(status_code=409, detail="Memory trace not running")
+    return {"file": os.path.basename(path)}
+
+@app.get("/admin/loop", dependencies=[Depends(require_admin)])
+async def get_loop_stats():
+    return loop_monitor.stats()
+
+@app.post("/admin/loop/debug", dependencies=[Depends(require_admin)])
+async def set_loop_debug(enabled: bool = True, slow_ms: float = 100):
+    loop_monitor.set_debug(enabled, slow_ms)
+    return loop_monitor.stats()
+
+@app.get("/admin/traces/{conn_id}", dependencies=[Depends(require_admin)])
+async def get_turn_traces(conn_id: int, n: int = 10, save: bool = False):
+    traces = turn_tracer.last(conn_id, n)
+    if not traces:
+        raise HTTPException(status_code=404, detail="No traces for this connection")
+    # Only write a file when asked, so polling doesn't fill profiles/
+    path = turn_tracer.dump(conn_id, n) if save else None
+    return {"file": os.path.basename(path) if path else None, "traces": traces}
+
+@app.get("/admin/files", dependencies=[Depends(require_admin)])
+async def get_profile_files():
+    return {"files": list_profiles()}
+
+@app.get("/admin/files/{name}", dependencies=[Depends(require_admin)])
+async def get_profile_file(name: str):
+    path = profile_path(name)
+    if path is None:
+        raise HTTPException(status_code=404, detail="No such file")
+    return FileResponse(path, filename=os.path.basename(path))
+
 @app.websocket("/ws")
 async def websocket_endpoint(websocket: WebSocket):
     import numpy as np
     await websocket.accept()
-    print("INFO:     connection open")
+    conn_id, reason = governor.admit()
+    if conn_id is None:
+        # Polite rejection rather than letting another child freeze the box
+        print(f"INFO:     connection rejected: {reason}")
+        try:
+            await websocket.send_json({"state": "busy", "message": BUSY_RESPONSE})
+            audio_data = phrase_cache.get(BUSY_RESPONSE) if phrase_cache else None
+            if audio_data:
+                await websocket.send_json({'text': BUSY_RESPONSE, 'audio': 'binary'})
+                await websocket.send_bytes(audio_data)
+            else:
+                await websocket.send_json({'text': BUSY_RESPONSE, 'tts': 'browser'})
+            await websocket.close(code=1013)
+        except Exception:
+            pass
+        return
+    print(f"INFO:     connection open (#{conn_id})")
+    outbound = OutboundQueue(
+        websocket,
+        maxsize=transport_config.get('queue_size', 32),
+        policy=transport_config.get('slow_consumer', 'drop_oldest'),
+        encoder=json_encoder,
+        # /metrics is unauthenticated, so the label carries no client address
+        name=f"#{conn_id}",
+    ).start()
     vad = vad_instance
-    stt = stt_instance
     llm = llm_instance  # Use shared LLM instance
     search = search_instance
     # Per-connection conversation history
@@ -139,13 +284,10 @@ async def websocket_endpoint(websocket: WebSocket):
     sample_rate = 16000
     frame_size = int(0.03 * sample_rate)  # 30ms
     max_buffer_size = sample_rate * 2 * 30  # 30 seconds max (16kHz * 2 bytes * 30s)
-    async def send_state(state, message=""):
-        try:
-            await websocket.send_json({"state": state, "message": message})
-        except Exception:
-            pass
+    # Sends are queued for the connection's writer task, never awaited here
+    send_state = outbound.send_state
     last_state = None
-    await send_state("ready")
+    send_state("ready")
     audio_chunks_received = 0
     speech_frames_detected = 0
     processing_count = 0
@@ -153,15 +295,20 @@ async def websocket_endpoint(websocket: WebSocket):
         while True:
             msg = await websocket.receive()
             if msg['type'] == 'websocket.receive':
+                frames = []
                 if 'text' in msg:
                     try:
                         data = json.loads(msg['text'])
                         if 'log' in data:
                             print(data['log'])
+                        # The capture worklet's energy gate closed: the child stopped talking
+                        if data.get('eos'):
+                            frames = [None]
                     except:
                         pass
                 elif 'bytes' in msg:
-                    # Now receiving raw PCM16 from browser (512 samples = 32ms at 16kHz)
+                    # Raw PCM16 from the browser's capture worklet: a batch of whole
+                    # 480-sample (30ms) frames, or 512 samples from the ScriptProcessor fallback
                     pcm = np.frombuffer(msg['bytes'], dtype=np.int16)
                     audio_chunks_received += 1
                     
@@ -172,140 +319,188 @@ async def websocket_endpoint(websocket: WebSocket):
                         continue
                     
                     # VAD requires exact frame sizes: 10ms, 20ms, or 30ms at 16kHz
-                    # We have 512 samples (32ms), so process in 480-sample (30ms) chunks
-                    for i in range(0, len(pcm) - frame_size + 1, frame_size):
-                        frame = pcm[i:i+frame_size]
+                    # Worklet batches are already aligned; fallback chunks lose their 32-sample tail
+                    frames = [pcm[i:i+frame_size] for i in range(0, len(pcm) - frame_size + 1, frame_size)]
+                
+                for frame in frames:
+                    if frame is None:
+                        # End of segment from the capture gate: counts as a finished silence window
+                        frame_bytes = b''
+                        buffered = True
+                        is_speech = False
+                        silence_time = max(silence_time, 1.0)
+                    else:
                         frame_bytes = frame.tobytes()
-                        
-                        # Prevent buffer overflow - reset if too large
-                        if len(buffer) > max_buffer_size:
-                            print(f"Buffer overflow detected ({len(buffer)} bytes), resetting...")
-                            buffer = b''
-                            silence_time = 0
-                            continue
-                        
-                        buffer += frame_bytes
+                    
+                    # Prevent buffer overflow - reset if too large
+                    if len(buffer) > max_buffer_size:
+                        print(f"Buffer overflow detected ({len(buffer)} bytes), resetting...")
+                        buffer = b''
+                        governor.clear_buffer(conn_id)
+                        silence_time = 0
+                        continue
+                    
+                    if frame is not None:
+                        # Global cap on audio held across all connections; a dropped frame
+                        # still goes through VAD so end of speech is detected and the buffer freed
+                        buffered = governor.reserve_buffer(conn_id, len(buffer) + len(frame_bytes))
+                        if buffered:
+                            buffer += frame_bytes
                         
                         is_speech = vad.is_speech(frame_bytes)
                         if is_speech:
                             speech_frames_detected += 1
-                        
-                        if not is_speech:
-                            silence_time += 0.03
-                            # Process after 1.0s silence AND minimum 2.0s of audio and some speech detected
-                            # Increased thresholds to reduce frequency on empty audio
-                            min_buffer_size = sample_rate * 2 * 2.0
-                            if silence_time > 1.0 and len(buffer) >= min_buffer_size and speech_frames_detected > 10:
-                                processing_count += 1
+                    
+                    if not is_speech:
+                        silence_time += 0.03
+                        # Process after 1.0s silence AND minimum 2.0s of audio and some speech detected
+                        # Increased thresholds to reduce frequency on empty audio
+                        # Over the global budget or at end of segment, process whatever we have
+                        min_buffer_size = sample_rate * 2 * 2.0
+                        enough_audio = len(buffer) >= min_buffer_size or ((not buffered or frame is None) and len(buffer) > 0)
+                        if silence_time > 1.0 and enough_audio and speech_frames_detected > 10:
+                            processing_count += 1
+                            governor.begin_turn(conn_id)
+                            stage = governor.stage()
+                            trace = turn_tracer.begin(conn_id, processing_count)
+                            trace.set(audio_s=round(len(buffer) / (sample_rate * 2), 2), stage=stage)
+                            try:
+                                if last_state != "processing":
+                                    send_state("processing")
+                                    last_state = "processing"
+                                
+                                # Log system resources every 5th processing
+                                if processing_count % 5 == 0:
+                                    print(f"Resources: {governor.snapshot()}")
+                                
+                                print(f"Transcribing {len(buffer)} bytes ({len(buffer)/(sample_rate*2):.1f}s audio)...")
+                                # Reduced timeout for faster response
+                                start_time = time.time()
                                 try:
-                                    if last_state != "processing":
-                                        await send_state("processing")
-                                        last_state = "processing"
-                                    
-                                    # Log system resources every 5th processing
-                                    if processing_count % 5 == 0:
-                                        mem = psutil.virtual_memory()
-                                        print(f"Memory: {mem.percent}% used ({mem.available / 1e9:.1f}GB free)")
+                                    stt = get_stt(stage)
+                                    text = await asyncio.wait_for(governor.transcribe(stt, buffer), timeout=10.0)
+                                    print(f"STT took {time.time() - start_time:.2f}s")
+                                    trace.mark('stt')
+                                except asyncio.TimeoutError:
+                                    print("STT timeout - system overloaded, skipping")
+                                    trace.set(outcome="stt_timeout")
+                                    send_state("idle")
+                                    last_state = "idle"
+                                    buffer = b''
+                                    governor.clear_buffer(conn_id)
+                                    silence_time = 0
+                                    continue
+                                except Exception as e:
+                                    print(f"STT error: {e}")
+                                    trace.set(outcome="stt_error")
+                                    send_state("idle")
+                                    last_state = "idle"
+                                    buffer = b''
+                                    governor.clear_buffer(conn_id)
+                                    silence_time = 0
+                                    continue
+                                
+                                print(f"Transcribed: {text}")
+                                buffer = b''
+                                governor.clear_buffer(conn_id)
+                                silence_time = 0
+                                
+                                # Skip if transcription is empty or too short
+                                if not text or len(text.strip()) < 3:
+                                    print("Skipping empty/short transcription")
+                                    trace.set(outcome="empty")
+                                    send_state("idle")
+                                    last_state = "idle"
+                                    continue
+                                
+                                if text.strip():  # Only process if we got text
+                                    # print(f"Querying context...")
+                                    # start_time = time.time()
+                                    # try:
+                                    #     context = await asyncio.wait_for(search.query(text), timeout=5.0)
+                                    #     print(f"Search took {time.time() - start_time:.2f}s")
+                                    # except asyncio.TimeoutError:
+                                    #     print("Search timeout")
+                                    context = ""
                                     
-                                    print(f"Transcribing {len(buffer)} bytes ({len(buffer)/(sample_rate*2):.1f}s audio)...")
-                                    # Reduced timeout for faster response
+                                    print(f"Generating response...")
                                     start_time = time.time()
                                     try:
-                                        text = await asyncio.wait_for(stt.transcribe(buffer), timeout=10.0)
-                                        print(f"STT took {time.time() - start_time:.2f}s")
+                                        response = await asyncio.wait_for(
+                                            llm.generate(text, context, conversation_history), 
+                                            timeout=30.0
+                                        )
+                                        print(f"LLM took {time.time() - start_time:.2f}s")
                                     except asyncio.TimeoutError:
-                                        print("STT timeout - system overloaded, skipping")
-                                        await send_state("idle")
-                                        last_state = "idle"
-                                        buffer = b''
-                                        silence_time = 0
-                                        continue
-                                    except Exception as e:
-                                        print(f"STT error: {e}")
-                                        await send_state("idle")
-                                        last_state = "idle"
-                                        buffer = b''
-                                        silence_time = 0
-                                        continue
+                                        print("LLM timeout")
+                                        response = LLM_TIMEOUT_RESPONSE
+                                        trace.set(outcome="llm_timeout")
+                                    if response == FALLBACK_RESPONSE:
+                                        trace.set(outcome="llm_error")
+                                    trace.mark('llm')
                                     
-                                    print(f"Transcribed: {text}")
-                                    buffer = b''
-                                    silence_time = 0
+                                    print(f"Response: {response}")
                                     
-                                    # Skip if transcription is empty or too short
-                                    if not text or len(text.strip()) < 3:
-                                        print("Skipping empty/short transcription")
-                                        await send_state("idle")
-                                        last_state = "idle"
-                                        continue
+                                    if last_state != "speaking":
+                                        send_state("speaking")
+                                        last_state = "speaking"
                                     
-                                    if text.strip():  # Only process if we got text
-                                        # print(f"Querying context...")
-                                        # start_time = time.time()
-                                        # try:
-                                        #     context = await asyncio.wait_for(search.query(text), timeout=5.0)
-                                        #     print(f"Search took {time.time() - start_time:.2f}s")
-                                        # except asyncio.TimeoutError:
-                                        #     print("Search timeout")
-                                        context = ""
-                                        
-                                        print(f"Generating response...")
-                                        start_time = time.time()
-                                        try:
-                                            response = await asyncio.wait_for(
-                                                llm.generate(text, context, conversation_history), 
-                                                timeout=30.0
-                                            )
-                                            print(f"LLM took {time.time() - start_time:.2f}s")
-                                        except asyncio.TimeoutError:
-                                            print("LLM timeout")
-                                            response = "Sorry, I'm taking too long to think. Can you try again?"
-                                        
-                                        print(f"Response: {response}")
-                                        
-                                        if last_state != "speaking":
-                                            await send_state("speaking")
-                                            last_state = "speaking"
-                                        
-                                        # Send text response
-                                        print(f"Sending response...")
-                                        if tts_provider == 'server':
-                                            # Generate TTS audio
-                                            audio_data = await asyncio.to_thread(generate_tts, response, voice_config)
-                                            print(f"Audio generated: {len(audio_data)} bytes")
-                                            audio_b64 = base64.b64encode(audio_data).decode('utf-8')
-                                            await websocket.send_json({'text': response, 'audio': audio_b64})
+                                    # Send text response
+                                    print(f"Sending response...")
+                                    if tts_provider == 'server':
+                                        # Fallback replies and degraded mode never trigger fresh synthesis
+                                        if response not in FALLBACK_PHRASES and stage < BROWSER_TTS:
+                                            audio_data = await phrase_cache.synthesize(response)
+                                            print(f"Audio ready: {len(audio_data)} bytes")
                                         else:
-                                            await websocket.send_json({'text': response})
-                                    
-                                    await send_state("idle")
-                                    last_state = "idle"
-                                    
-                                    # Aggressive cleanup to prevent memory accumulation
-                                    gc.collect()
-                                    if torch.cuda.is_available():
-                                        torch.cuda.empty_cache()
-                                    
-                                    # Log memory after processing every 5th
-                                    if processing_count % 5 == 0:
-                                        mem = psutil.virtual_memory()
-                                        print(f"Memory after processing: {mem.percent}% used ({mem.available / 1e9:.1f}GB free)")
-                                except Exception as e:
-                                    print(f"Error in processing: {e}")
-                                    import traceback
-                                    traceback.print_exc()
-                                    await send_state("error", str(e))
-                                    buffer = b''
-                                    silence_time = 0
-                        else:
-                            silence_time = 0
-                            if last_state != "listening":
-                                await send_state("listening")
-                                last_state = "listening"
+                                            audio_data = phrase_cache.get(response)
+                                        if audio_data:
+                                            # WAV goes out as a binary frame right after its text
+                                            outbound.send_audio({'text': response, 'audio': 'binary'}, audio_data)
+                                        else:
+                                            # No cached audio: the browser speaks instead
+                                            outbound.send_json({'text': response, 'tts': 'browser'})
+                                    else:
+                                        outbound.send_json({'text': response})
+                                    trace.mark('tts')
+                                    trace.set(outbound_depth=outbound.depth())
+                                
+                                send_state("idle")
+                                last_state = "idle"
+                                
+                                # Aggressive cleanup to prevent memory accumulation
+                                gc.collect()
+                                if torch.cuda.is_available():
+                                    torch.cuda.empty_cache()
+                                trace.mark('cleanup')
+                                
+                                # Log memory after processing every 5th
+                                if processing_count % 5 == 0:
+                                    mem = psutil.virtual_memory()
+                                    print(f"Memory after processing: {mem.percent}% used ({mem.available / 1e9:.1f}GB free)")
+                            except Exception as e:
+                                print(f"Error in processing: {e}")
+                                import traceback
+                                traceback.print_exc()
+                                send_state("error", str(e))
+                                trace.set(outcome="error", error=str(e))
+                                buffer = b''
+                                governor.clear_buffer(conn_id)
+                                silence_time = 0
+                            finally:
+                                governor.end_turn(conn_id)
+                                turn_tracer.end(conn_id, trace)
+                    else:
+                        silence_time = 0
+                        if last_state != "listening":
+                            send_state("listening")
+                            last_state = "listening"
     except Exception as e:
         print(f"INFO:     connection closed: {e}")
     finally:
         # Cleanup resources
+        await outbound.close()
+        governor.release(conn_id)
         buffer = b''
         conversation_history.clear()
         if torch.cuda.is_available():
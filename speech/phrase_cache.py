@@ -0,0 +1,96 @@
+import asyncio
+import hashlib
+import json
+import os
+from collections import OrderedDict
+
+class PhraseCache:
+    def __init__(self, synthesize, voice_config, voice_id="default", directory='models/tts_cache', max_mb=32):
+        """Cache of synthesized speech, so repeated phrases skip TTS.
+
+        Fixed phrases (fallback replies, greetings) are synthesized once at startup
+        and persisted to disk; other responses go into a size-bounded in-memory LRU.
+
+        Args:
+            synthesize: Blocking function text -> WAV bytes (run in a thread)
+            voice_config: Voice settings; rate and volume are part of the cache key
+            voice_id: Server voice name/id, also part of the key
+            directory: Where fixed phrase WAVs are persisted
+            max_mb: Budget for the LRU of arbitrary responses
+        """
+        self.synthesize_fn = synthesize
+        self.voice_config = voice_config
+        self.voice_id = voice_id
+        self.directory = directory
+        self.max_bytes = int(max_mb * 1e6)
+        self.fixed = {}
+        self.recent = OrderedDict()
+        self.recent_bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, text):
+        parts = [text, self.voice_id, self.voice_config.get('rate', 1.0), self.voice_config.get('volume', 1.0)]
+        return hashlib.sha1(json.dumps(parts).encode('utf-8')).hexdigest()
+
+    def prewarm(self, phrases):
+        """Load fixed phrases from disk, synthesizing any that aren't there yet."""
+        os.makedirs(self.directory, exist_ok=True)
+        for text in phrases:
+            key = self.key(text)
+            path = os.path.join(self.directory, f"{key}.wav")
+            try:
+                if os.path.exists(path):
+                    with open(path, 'rb') as f:
+                        self.fixed[key] = f.read()
+                    continue
+                audio = self.synthesize_fn(text)
+                with open(path, 'wb') as f:
+                    f.write(audio)
+                self.fixed[key] = audio
+            except Exception as e:
+                print(f"Could not prepare phrase audio for {text!r}: {e}")
+        print(f"Phrase audio ready: {len(self.fixed)}/{len(phrases)} fixed phrases")
+
+    def get(self, text):
+        """Cached audio for text, or None. Never synthesizes."""
+        key = self.key(text)
+        audio = self.fixed.get(key)
+        if audio is None:
+            audio = self.recent.get(key)
+            if audio is not None:
+                self.recent.move_to_end(key)
+        if audio is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return audio
+
+    async def synthesize(self, text):
+        """Cached audio for text, synthesizing (off the event loop) and caching on a miss."""
+        audio = self.get(text)
+        if audio is not None:
+            return audio
+        audio = await asyncio.to_thread(self.synthesize_fn, text)
+        self._remember(self.key(text), audio)
+        return audio
+
+    def _remember(self, key, audio):
+        if len(audio) > self.max_bytes:
+            return
+        if key in self.recent:
+            self.recent_bytes -= len(self.recent.pop(key))
+        self.recent[key] = audio
+        self.recent_bytes += len(audio)
+        while self.recent_bytes > self.max_bytes:
+            _, old = self.recent.popitem(last=False)
+            self.recent_bytes -= len(old)
+
+    def stats(self):
+        return {
+            "fixed_phrases": len(self.fixed),
+            "recent_entries": len(self.recent),
+            "recent_bytes": self.recent_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+        }
@@ -0,0 +1,205 @@
+import asyncio
+import itertools
+import psutil
+from collections import deque
+
+try:
+    import torch
+except ImportError:
+    torch = None
+
+# Degradation stages, in order of increasing pressure
+NORMAL = 0
+SMALL_WHISPER = 1   # transcribe with the tiny Whisper model
+BROWSER_TTS = 2     # skip server TTS, let the browser speak
+REJECT = 3          # politely turn away new connections
+
+STAGE_NAMES = {
+    NORMAL: "normal",
+    SMALL_WHISPER: "small-whisper",
+    BROWSER_TTS: "browser-tts",
+    REJECT: "reject",
+}
+
+
+def _stage_for(value, thresholds, higher_is_worse=True):
+    """Map a reading onto a stage using up to three thresholds, one per stage.
+
+    Thresholds ascend when higher readings are worse (memory, CPU) and descend
+    when lower readings are worse (higher_is_worse=False, e.g. free GPU memory).
+    """
+    stage = NORMAL
+    for i, limit in enumerate(thresholds or []):
+        if limit is None:
+            continue
+        if (value >= limit) if higher_is_worse else (value <= limit):
+            stage = i + 1
+    return stage
+
+
+class ResourceGovernor:
+    def __init__(self, config=None):
+        """Track live resource use and per-connection load, and decide how far to degrade.
+
+        Args:
+            config: The 'governor' section of config.json. Stage thresholds are lists
+                for stages 1-3 (small Whisper, browser TTS, reject).
+        """
+        config = config or {}
+        self.max_connections = config.get('max_connections', 4)
+        # Default budget: on average 10s of 16kHz PCM16 per allowed connection
+        default_mb = self.max_connections * 10 * 16000 * 2 / 1e6
+        self.max_buffered_bytes = int(config.get('max_buffered_audio_mb', default_mb) * 1e6)
+        self.max_decodes = config.get('max_concurrent_decodes', 1)
+        self.memory_percent = config.get('memory_percent', [80, 88, 95])
+        self.cpu_percent = config.get('cpu_percent', [85, 95])
+        self.gpu_free_mb = config.get('gpu_free_mb', [1500, 800, 300])
+        self.rss_mb = config.get('rss_mb', [])
+        self.sample_interval = config.get('sample_interval', 1.0)
+        # CPU is averaged over this recent window rather than since the last turn
+        self.cpu_window = deque(maxlen=max(1, round(config.get('cpu_window_s', 5) / self.sample_interval)))
+
+        self.decode_slots = asyncio.Semaphore(self.max_decodes)
+        self.decoding = 0
+        self.decodes_waiting = 0
+        self.ids = itertools.count(1)
+        self.connections = {}  # conn_id -> {'buffered': bytes, 'turns': in-flight turns}
+        self.dropped_frames = 0
+        self.rejected = 0
+
+        self.process = psutil.Process()
+        self.readings = {}
+        self.sampler = None
+        self.current_stage = NORMAL
+        self.sample()
+
+    def start(self):
+        """Start sampling resources every sample_interval; call from the running event loop."""
+        if self.sampler is None:
+            self.sampler = asyncio.create_task(self._run_sampler())
+
+    async def _run_sampler(self):
+        while True:
+            await asyncio.sleep(self.sample_interval)
+            try:
+                self.sample()
+            except Exception as e:
+                print(f"Resource sampling failed: {e}")
+
+    def sample(self):
+        """Take one reading; CPU covers the time since the previous sample."""
+        mem = psutil.virtual_memory()
+        self.cpu_window.append(psutil.cpu_percent(None))
+        readings = {
+            'memory_percent': mem.percent,
+            'memory_available_gb': round(mem.available / 1e9, 2),
+            'rss_mb': round(self.process.memory_info().rss / 1e6, 1),
+            'cpu_percent': round(sum(self.cpu_window) / len(self.cpu_window), 1),
+        }
+        if torch is not None and torch.cuda.is_available():
+            free, total = torch.cuda.mem_get_info()
+            readings['gpu_free_mb'] = round(free / 1e6, 1)
+            readings['gpu_total_mb'] = round(total / 1e6, 1)
+        self.readings = readings
+        return readings
+
+    def stage(self):
+        """Current degradation stage, from the latest readings and in-flight audio/decodes."""
+        r = self.readings
+        stage = max(
+            _stage_for(r['memory_percent'], self.memory_percent),
+            _stage_for(r['cpu_percent'], self.cpu_percent),
+            _stage_for(r['rss_mb'], self.rss_mb),
+        )
+        if 'gpu_free_mb' in r:
+            stage = max(stage, _stage_for(r['gpu_free_mb'], self.gpu_free_mb, higher_is_worse=False))
+        # Decodes queueing behind the limit means Whisper can't keep up
+        if self.decodes_waiting > 0:
+            stage = max(stage, SMALL_WHISPER)
+        if self.buffered_bytes() >= self.max_buffered_bytes:
+            stage = max(stage, SMALL_WHISPER)
+        if stage != self.current_stage:
+            print(f"Resource governor: {STAGE_NAMES[self.current_stage]} -> {STAGE_NAMES[stage]} ({r})")
+            self.current_stage = stage
+        return stage
+
+    def admit(self):
+        """Register a new connection. Returns (conn_id, None) or (None, reason)."""
+        if len(self.connections) >= self.max_connections:
+            self.rejected += 1
+            return None, f"max connections ({self.max_connections}) reached"
+        if self.stage() >= REJECT:
+            self.rejected += 1
+            return None, "server under resource pressure"
+        conn_id = next(self.ids)
+        self.connections[conn_id] = {'buffered': 0, 'turns': 0}
+        return conn_id, None
+
+    def release(self, conn_id):
+        self.connections.pop(conn_id, None)
+
+    def buffered_bytes(self):
+        return sum(c['buffered'] for c in self.connections.values())
+
+    def reserve_buffer(self, conn_id, size):
+        """Record that conn_id wants to hold size bytes of audio; False if over the global budget."""
+        conn = self.connections.get(conn_id)
+        if conn is None:
+            return True
+        if size > conn['buffered'] and self.buffered_bytes() - conn['buffered'] + size > self.max_buffered_bytes:
+            self.dropped_frames += 1
+            if self.dropped_frames % 100 == 1:
+                print(f"Global audio budget ({self.max_buffered_bytes} bytes) full, dropping frames")
+            return False
+        conn['buffered'] = size
+        return True
+
+    def clear_buffer(self, conn_id):
+        """Record that conn_id dropped its audio buffer."""
+        if conn_id in self.connections:
+            self.connections[conn_id]['buffered'] = 0
+
+    def begin_turn(self, conn_id):
+        if conn_id in self.connections:
+            self.connections[conn_id]['turns'] += 1
+
+    def end_turn(self, conn_id):
+        if conn_id in self.connections:
+            self.connections[conn_id]['turns'] -= 1
+
+    async def transcribe(self, stt, audio_bytes):
+        """Run stt.transcribe under the concurrent-decode limit.
+
+        The slot is held until the decode thread actually finishes, so a caller
+        timing out doesn't let another decode pile onto the CPU.
+        """
+        self.decodes_waiting += 1
+        try:
+            await self.decode_slots.acquire()
+        finally:
+            self.decodes_waiting -= 1
+        self.decoding += 1
+        task = asyncio.create_task(stt.transcribe(audio_bytes))
+
+        def _done(_):
+            self.decoding -= 1
+            self.decode_slots.release()
+        task.add_done_callback(_done)
+        return await asyncio.shield(task)
+
+    def snapshot(self):
+        stage = self.stage()
+        return {
+            'stage': STAGE_NAMES[stage],
+            'readings': self.readings,
+            'connections': len(self.connections),
+            'max_connections': self.max_connections,
+            'buffered_audio_bytes': self.buffered_bytes(),
+            'max_buffered_audio_bytes': self.max_buffered_bytes,
+            'decoding': self.decoding,
+            'decodes_waiting': self.decodes_waiting,
+            'max_concurrent_decodes': self.max_decodes,
+            'in_flight_turns': sum(c['turns'] for c in self.connections.values()),
+            'dropped_frames': self.dropped_frames,
+            'rejected_connections': self.rejected,
+        }
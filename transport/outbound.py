@@ -0,0 +1,165 @@
+import asyncio
+import json
+import time
+from collections import deque
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# Live writers, for the /metrics endpoint
+_writers = set()
+
+
+def get_encoder(name="json"):
+    """Return a dumps function producing str.
+
+    Args:
+        name: 'orjson' for the fast encoder (falls back to stdlib json if not installed), or 'json'
+    """
+    if name == "orjson":
+        if orjson is not None:
+            return lambda obj: orjson.dumps(obj).decode('utf-8')
+        print("orjson not installed, using stdlib json for websocket messages")
+    return json.dumps
+
+
+class OutboundQueue:
+    def __init__(self, websocket, maxsize=32, policy="drop_oldest", encoder=None, name=""):
+        """Per-connection websocket writer with a bounded outbound queue.
+
+        Senders never await the network: messages are queued and a writer task
+        drains them, so a slow client can't throttle its own audio ingestion.
+
+        Args:
+            websocket: Accepted FastAPI WebSocket
+            maxsize: Max queued messages before the slow-consumer policy applies
+            policy: 'drop_oldest' to discard the oldest queued message (states first), or 'close' to disconnect
+            encoder: Function turning a dict into a JSON string (see get_encoder)
+            name: Label used in metrics and logs
+        """
+        self.websocket = websocket
+        self.maxsize = maxsize
+        self.policy = policy
+        self.encoder = encoder or json.dumps
+        self.name = name
+        self.queue = deque()
+        self.wakeup = asyncio.Event()
+        self.task = None
+        self.closed = False
+        # Metrics
+        self.sent = 0
+        self.dropped = 0
+        self.coalesced = 0
+        self.max_depth = 0
+        self.opened_at = time.time()
+
+    def start(self):
+        self.task = asyncio.create_task(self._run())
+        _writers.add(self)
+        return self
+
+    def send_state(self, state, message=""):
+        """Queue a state update, replacing an unsent state only if nothing was queued after it."""
+        payload = {"state": state, "message": message}
+        if self.queue and self.queue[-1][0] == 'state':
+            self.queue[-1][1] = payload
+            self.coalesced += 1
+            return
+        self._put(['state', payload])
+
+    def send_json(self, data):
+        self._put(['text', data])
+
+    def send_bytes(self, data):
+        self._put(['bytes', data])
+
+    def send_audio(self, header, data):
+        """Queue a JSON header and its binary audio as one item, so they are sent or dropped together."""
+        self._put(['audio', (header, data)])
+
+    def depth(self):
+        return len(self.queue)
+
+    def _drop_oldest(self):
+        # Stale states are the cheapest loss; otherwise drop the oldest message
+        for old in self.queue:
+            if old[0] == 'state':
+                break
+        else:
+            old = self.queue[0]
+        self.queue.remove(old)
+        self.dropped += 1
+
+    def _put(self, item):
+        if self.closed:
+            return
+        if self.depth() >= self.maxsize:
+            if self.policy == "close":
+                print(f"Slow consumer {self.name}: outbound queue full, closing")
+                self.closed = True
+                self.wakeup.set()
+                asyncio.create_task(self._close_socket())
+                return
+            self._drop_oldest()
+        self.queue.append(item)
+        self.max_depth = max(self.max_depth, self.depth())
+        self.wakeup.set()
+
+    async def _run(self):
+        try:
+            while not self.closed:
+                await self.wakeup.wait()
+                self.wakeup.clear()
+                while self.queue:
+                    kind, payload = self.queue.popleft()
+                    if kind == 'bytes':
+                        await self.websocket.send_bytes(payload)
+                    elif kind == 'audio':
+                        header, data = payload
+                        await self.websocket.send_text(self.encoder(header))
+                        await self.websocket.send_bytes(data)
+                    else:
+                        await self.websocket.send_text(self.encoder(payload))
+                    self.sent += 1
+        except asyncio.CancelledError:
+            pass
+        except Exception as e:
+            # Client went away; stop writing, the receive loop will notice the close
+            print(f"Outbound writer {self.name} stopped: {e}")
+        finally:
+            self.closed = True
+            self.queue.clear()
+
+    async def _close_socket(self):
+        try:
+            await self.websocket.close(code=1013)
+        except Exception:
+            pass
+
+    async def close(self):
+        self.closed = True
+        _writers.discard(self)
+        if self.task:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+
+    def metrics(self):
+        return {
+            "connection": self.name,
+            "queue_depth": self.depth(),
+            "max_queue_depth": self.max_depth,
+            "sent": self.sent,
+            "dropped": self.dropped,
+            "coalesced_states": self.coalesced,
+            "uptime_s": round(time.time() - self.opened_at, 1),
+        }
+
+
+def queue_metrics():
+    """Metrics for every open connection's outbound queue."""
+    return [w.metrics() for w in list(_writers)]
@@ -0,0 +1,261 @@
+import asyncio
+import json
+import logging
+import os
+import sys
+import threading
+import time
+import tracemalloc
+from collections import Counter, OrderedDict, deque
+
+PROFILE_DIR = 'profiles'
+MAX_PROFILE_FILES = 50
+
+# Innermost frames of threads parked waiting for work or I/O, not using CPU
+IDLE_FRAMES = {
+    ('threading.py', 'wait'),
+    ('selectors.py', 'select'),
+    ('queue.py', 'get'),
+    ('base_events.py', 'run_until_complete'),
+    ('runners.py', 'run'),
+}
+
+
+def _output_path(prefix, ext):
+    """New output file path; the oldest files are removed beyond MAX_PROFILE_FILES."""
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    files = sorted(
+        (os.path.join(PROFILE_DIR, name) for name in os.listdir(PROFILE_DIR)),
+        key=os.path.getmtime,
+    )
+    for old in files[:max(0, len(files) - MAX_PROFILE_FILES + 1)]:
+        os.unlink(old)
+    return os.path.join(PROFILE_DIR, f"{prefix}-{time.strftime('%Y%m%d-%H%M%S')}.{ext}")
+
+
+class SamplingProfiler:
+    def __init__(self, interval=0.005):
+        """Wall-clock sampling profiler over all threads, no extra dependencies.
+
+        Stacks are written in collapsed ("folded") format, one line per unique
+        stack with its sample count, which flamegraph.pl and speedscope read.
+        Threads parked in a known wait (IDLE_FRAMES) are skipped, but any other
+        blocking call (sleep, network I/O) still shows up as wall-clock time.
+
+        Args:
+            interval: Seconds between samples
+        """
+        self.interval = interval
+        self.thread = None
+        self.stop_event = threading.Event()
+        self.stacks = Counter()
+        self.samples = 0
+        self.idle = 0
+        self.last_file = None
+
+    @property
+    def running(self):
+        return self.thread is not None and self.thread.is_alive()
+
+    def start(self, seconds):
+        if self.running:
+            return False
+        self.stacks = Counter()
+        self.samples = 0
+        self.idle = 0
+        self.stop_event.clear()
+        self.thread = threading.Thread(target=self._run, args=(seconds,), daemon=True, name="sampling-profiler")
+        self.thread.start()
+        return True
+
+    def stop(self):
+        self.stop_event.set()
+        if self.thread:
+            self.thread.join(timeout=5)
+        return self.last_file
+
+    def _run(self, seconds):
+        me = threading.get_ident()
+        names = {}
+        deadline = time.monotonic() + seconds
+        while not self.stop_event.is_set() and time.monotonic() < deadline:
+            for thread in threading.enumerate():
+                names[thread.ident] = thread.name
+            for ident, frame in sys._current_frames().items():
+                if ident == me:
+                    continue
+                code = frame.f_code
+                if (os.path.basename(code.co_filename), code.co_name) in IDLE_FRAMES:
+                    self.idle += 1
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})")
+                    frame = frame.f_back
+                stack.append(names.get(ident, str(ident)))
+                self.stacks[';'.join(reversed(stack))] += 1
+            self.samples += 1
+            time.sleep(self.interval)
+        self.last_file = self._write()
+
+    def _write(self):
+        path = _output_path('cpu', 'folded')
+        with open(path, 'w') as f:
+            for stack, count in self.stacks.most_common():
+                f.write(f"{stack} {count}\n")
+        print(f"CPU profile written: {path} ({self.samples} samples, {self.idle} idle thread samples skipped)")
+        return path
+
+
+class MemoryTracer:
+    def __init__(self, frames=10):
+        """tracemalloc snapshot diff between start() and stop()."""
+        self.frames = frames
+        self.baseline = None
+
+    @property
+    def running(self):
+        return self.baseline is not None
+
+    def start(self):
+        if self.running:
+            return False
+        tracemalloc.start(self.frames)
+        self.baseline = tracemalloc.take_snapshot()
+        return True
+
+    def stop(self, top=50):
+        if not self.running:
+            return None
+        snapshot = tracemalloc.take_snapshot()
+        stats = snapshot.compare_to(self.baseline, 'lineno')
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        self.baseline = None
+        path = _output_path('memory', 'txt')
+        with open(path, 'w') as f:
+            f.write(f"Traced memory: current {current / 1e6:.1f}MB, peak {peak / 1e6:.1f}MB\n\n")
+            for stat in stats[:top]:
+                f.write(f"{stat}\n")
+        print(f"Memory diff written: {path}")
+        return path
+
+
+class _SlowCallbackHandler(logging.Handler):
+    """Collects asyncio debug-mode 'Executing ... took N seconds' warnings."""
+
+    def __init__(self, records):
+        super().__init__(logging.WARNING)
+        self.records = records
+
+    def emit(self, record):
+        message = record.getMessage()
+        if 'took' in message:
+            self.records.append({"time": record.created, "message": message})
+
+
+class LoopMonitor:
+    def __init__(self, interval=0.1, history=200):
+        """Event-loop lag: a ticker measuring sleep overshoot, plus asyncio debug-mode slow callbacks."""
+        self.interval = interval
+        self.lags = deque(maxlen=history)
+        self.slow_callbacks = deque(maxlen=history)
+        self.handler = _SlowCallbackHandler(self.slow_callbacks)
+        self.task = None
+        self.debug = False
+
+    def start(self):
+        if self.task is None:
+            self.task = asyncio.create_task(self._run())
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            start = loop.time()
+            await asyncio.sleep(self.interval)
+            self.lags.append(loop.time() - start - self.interval)
+
+    def set_debug(self, enabled, slow_callback_ms=100):
+        """Toggle asyncio debug mode so callbacks slower than slow_callback_ms are logged."""
+        loop = asyncio.get_running_loop()
+        loop.set_debug(enabled)
+        loop.slow_callback_duration = slow_callback_ms / 1000
+        logger = logging.getLogger('asyncio')
+        if enabled and not self.debug:
+            logger.addHandler(self.handler)
+        elif not enabled and self.debug:
+            logger.removeHandler(self.handler)
+        self.debug = enabled
+
+    def stats(self):
+        lags = sorted(self.lags)
+        return {
+            "debug": self.debug,
+            "samples": len(lags),
+            "lag_ms_p50": round(lags[len(lags) // 2] * 1000, 1) if lags else None,
+            "lag_ms_max": round(lags[-1] * 1000, 1) if lags else None,
+            "slow_callbacks": list(self.slow_callbacks)[-20:],
+        }
+
+
+class TurnTrace:
+    def __init__(self, turn):
+        """Timings for one speech turn; mark() records the time since the previous mark."""
+        self.data = {"turn": turn, "started": time.time()}
+        self.start = self.last = time.perf_counter()
+
+    def mark(self, name):
+        now = time.perf_counter()
+        self.data[f"{name}_s"] = round(now - self.last, 4)
+        self.last = now
+
+    def set(self, **fields):
+        self.data.update(fields)
+
+
+class TurnTracer:
+    def __init__(self, per_connection=50, connections=20):
+        """Keeps the last per_connection turn traces for the most recent connections."""
+        self.per_connection = per_connection
+        self.connections = connections
+        self.traces = OrderedDict()  # conn_id -> deque of trace dicts
+
+    def begin(self, conn_id, turn):
+        if conn_id not in self.traces:
+            self.traces[conn_id] = deque(maxlen=self.per_connection)
+            while len(self.traces) > self.connections:
+                self.traces.popitem(last=False)
+        return TurnTrace(turn)
+
+    def end(self, conn_id, trace):
+        trace.data.setdefault("outcome", "ok")
+        trace.data["total_s"] = round(time.perf_counter() - trace.start, 4)
+        if conn_id in self.traces:
+            self.traces[conn_id].append(trace.data)
+
+    def last(self, conn_id, n=10):
+        return list(self.traces.get(conn_id, []))[-n:]
+
+    def dump(self, conn_id, n=10):
+        """Write the last n traces to a file; None if there are none."""
+        traces = self.last(conn_id, n)
+        if not traces:
+            return None
+        path = _output_path(f"traces-{conn_id}", 'json')
+        with open(path, 'w') as f:
+            json.dump(traces, f, indent=2)
+        return path
+
+
+def list_profiles():
+    if not os.path.isdir(PROFILE_DIR):
+        return []
+    return sorted(os.listdir(PROFILE_DIR))
+
+
+def profile_path(name):
+    """Path of a profile output file, or None. Only plain names inside PROFILE_DIR."""
+    name = os.path.basename(name)
+    path = os.path.join(PROFILE_DIR, name)
+    return path if os.path.isfile(path) else None